@@ -5,16 +5,24 @@ Fetches historical OHLCV candlestick data from Binance
 and stores it locally for downstream processing.
 """
 
-import time
+import functools
+import numpy as np
+import orjson
 import requests
 import pandas as pd
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Optional, Iterable
+from typing import Optional, Iterable, Iterator
 
 import logging
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+
+from src.utils.http import build_session
+from src.utils.rate_limit import TokenBucket
 
 # =========================
 # Configuration
@@ -31,64 +39,89 @@ DEFAULT_SYMBOLS = ("BTCUSDT", "ETHUSDT")
 DEFAULT_INTERVAL = "1d"  # daily data (perfect for ML)
 DEFAULT_START_DATE = "2017-08-01"
 REQUEST_LIMIT = 1000
-RATE_LIMIT_SLEEP = 0.2  # seconds
+KLINES_REQUEST_WEIGHT = 2  # Binance request weight of one klines call
+MAX_WORKERS = 4  # symbols fetched concurrently
+
+# Binance allows 1200 request weight per minute, shared by every symbol;
+# capacity + 60 * refill_rate stays within that for any 60s window
+BINANCE_BUCKET = TokenBucket(capacity=20, refill_rate=1180 / 60)
 
 DATA_DIR = Path("data/raw/crypto")
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-KLINE_COLUMNS = [
-    "open_time",
-    "open",
-    "high",
-    "low",
-    "close",
-    "volume",
-    "close_time",
-    "quote_asset_volume",
-    "num_trades",
-    "taker_buy_base_volume",
-    "taker_buy_quote_volume",
-    "ignore",
-]
+KLINE_SCHEMA = pa.schema(
+    [
+        ("open_time", pa.timestamp("ns", tz="UTC")),
+        ("open", pa.float64()),
+        ("high", pa.float64()),
+        ("low", pa.float64()),
+        ("close", pa.float64()),
+        ("volume", pa.float64()),
+        ("close_time", pa.timestamp("ns", tz="UTC")),
+        ("quote_asset_volume", pa.float64()),
+        ("num_trades", pa.int64()),
+        ("taker_buy_base_volume", pa.float64()),
+        ("taker_buy_quote_volume", pa.float64()),
+    ]
+)
+KLINE_COLUMNS = KLINE_SCHEMA.names
+
+# One pooled session shared by every symbol so connections are reused
+_SESSION = build_session("crypto-ingestion/1.0")
 
 # =========================
 # Helpers
 # =========================
 
+@functools.lru_cache(maxsize=128)
 def _to_millis(ts: Optional[str | datetime]) -> Optional[int]:
     if ts is None:
         return None
-    return int(pd.Timestamp(ts, tz="UTC").timestamp() * 1000)
+    if isinstance(ts, str):
+        # ISO dates like "2017-08-01" skip the pandas parser
+        try:
+            ts = datetime.fromisoformat(ts)
+        except ValueError:
+            ts = pd.Timestamp(ts)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp() * 1000)
+
+
+def _klines_to_frame(rows: list[list]) -> pd.DataFrame:
+    """Build the klines frame with each column created directly in its final dtype."""
+    arr = np.array(rows, dtype=object)
+    return pd.DataFrame(
+        {
+            "open_time": pd.to_datetime(arr[:, 0].astype(np.int64), unit="ms", utc=True),
+            "open": arr[:, 1].astype(np.float64),
+            "high": arr[:, 2].astype(np.float64),
+            "low": arr[:, 3].astype(np.float64),
+            "close": arr[:, 4].astype(np.float64),
+            "volume": arr[:, 5].astype(np.float64),
+            "close_time": pd.to_datetime(arr[:, 6].astype(np.int64), unit="ms", utc=True),
+            "quote_asset_volume": arr[:, 7].astype(np.float64),
+            "num_trades": arr[:, 8].astype(np.int64),
+            "taker_buy_base_volume": arr[:, 9].astype(np.float64),
+            "taker_buy_quote_volume": arr[:, 10].astype(np.float64),
+        },
+        columns=KLINE_COLUMNS,
+    )
 
 # =========================
 # Core Functions
 # =========================
 
-def fetch_binance_klines(
+def _iter_kline_pages(
     symbol: str,
-    interval: str = DEFAULT_INTERVAL,
-    start_date: str | datetime = DEFAULT_START_DATE,
-    end_date: Optional[str | datetime] = None,
-) -> pd.DataFrame:
-    """
-    Fetch historical kline (candlestick) data for a symbol from Binance.
-    """
-    start_ms = _to_millis(start_date)
-    end_ms = _to_millis(end_date)
+    interval: str,
+    start_ms: Optional[int],
+    end_ms: Optional[int],
+    session: requests.Session,
+) -> Iterator[list[list]]:
+    """Yield the raw klines of each Binance page, in open_time order."""
     next_start = start_ms
 
-    frames: list[pd.DataFrame] = []
-    session = requests.Session()
-    retries = Retry(
-        total=5,
-        backoff_factor=0.5,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET"],
-    )
-    adapter = HTTPAdapter(max_retries=retries)
-    session.mount("https://", adapter)
-    session.headers.update({"User-Agent": "crypto-ingestion/1.0"})
-
     while True:
         params = {
             "symbol": symbol.upper(),
@@ -99,77 +132,249 @@ def fetch_binance_klines(
         if end_ms:
             params["endTime"] = end_ms
 
+        BINANCE_BUCKET.acquire(KLINES_REQUEST_WEIGHT)
         resp = session.get(f"{BINANCE_BASE_URL}/klines", params=params, timeout=30)
         resp.raise_for_status()
-        klines = resp.json()
+        klines = orjson.loads(resp.content)
 
         if not klines:
             break
 
-        frame = pd.DataFrame(klines, columns=KLINE_COLUMNS)
-        frames.append(frame)
+        # The 12th kline field is an unused placeholder; drop it at parse time
+        yield [k[:11] for k in klines]
 
-        last_close_time = int(frame["close_time"].iloc[-1])
+        # close_time is already an int in the raw Binance JSON
+        last_close_time = klines[-1][6]
         next_start = last_close_time + 1
 
-        if (end_ms and next_start >= end_ms) or len(frame) < REQUEST_LIMIT:
+        if (end_ms and next_start >= end_ms) or len(klines) < REQUEST_LIMIT:
             break
 
-        time.sleep(RATE_LIMIT_SLEEP)
 
-    if not frames:
-        raise ValueError(f"No data returned for {symbol}")
+def _fetch_first_open_time(
+    symbol: str, interval: str, start_ms: int, session: requests.Session = _SESSION
+) -> Optional[int]:
+    """Return the open_time (ms) of the first bar at or after start_ms, if any."""
+    params = {
+        "symbol": symbol.upper(),
+        "interval": interval,
+        "limit": 1,
+        "startTime": start_ms,
+    }
+    BINANCE_BUCKET.acquire(KLINES_REQUEST_WEIGHT)
+    resp = session.get(f"{BINANCE_BASE_URL}/klines", params=params, timeout=30)
+    resp.raise_for_status()
+    klines = orjson.loads(resp.content)
+    return klines[0][0] if klines else None
 
-    df = pd.concat(frames, ignore_index=True)
-
-    # Type conversions
-    numeric_cols = [
-        "open",
-        "high",
-        "low",
-        "close",
-        "volume",
-        "quote_asset_volume",
-        "taker_buy_base_volume",
-        "taker_buy_quote_volume",
-    ]
-    df[numeric_cols] = df[numeric_cols].astype(float)
-    df["num_trades"] = df["num_trades"].astype(int)
 
-    df["open_time"] = pd.to_datetime(df["open_time"], unit="ms", utc=True)
-    df["close_time"] = pd.to_datetime(df["close_time"], unit="ms", utc=True)
+def fetch_binance_klines(
+    symbol: str,
+    interval: str = DEFAULT_INTERVAL,
+    start_date: str | datetime = DEFAULT_START_DATE,
+    end_date: Optional[str | datetime] = None,
+    session: requests.Session = _SESSION,
+) -> pd.DataFrame:
+    """
+    Fetch historical kline (candlestick) data for a symbol from Binance.
+    """
+    rows: list[list] = []
+    for page in _iter_kline_pages(
+        symbol, interval, _to_millis(start_date), _to_millis(end_date), session
+    ):
+        rows.extend(page)
+
+    if not rows:
+        raise ValueError(f"No data returned for {symbol}")
 
-    return df.sort_values("open_time").reset_index(drop=True)
+    # Binance pages arrive in open_time order, so the frame is already sorted
+    df = _klines_to_frame(rows)
+    assert df["open_time"].is_monotonic_increasing
+    return df
 
 # =========================
 # Persistence
 # =========================
 
-def save_crypto_data(df: pd.DataFrame, symbol: str, interval: str) -> Path:
-    file_path = DATA_DIR / f"{symbol}_{interval}.csv"
-    df.to_csv(file_path, index=False)
+def _crypto_data_path(symbol: str, interval: str) -> Path:
+    return DATA_DIR / f"{symbol}_{interval}.parquet"
+
+
+def _export_csv(file_path: Path) -> Path:
+    """Copy a Parquet file to CSV for external consumers, one row group at a time."""
+    csv_path = file_path.with_suffix(".csv")
+    with pq.ParquetFile(file_path) as source:
+        with pacsv.CSVWriter(csv_path, source.schema_arrow) as writer:
+            for batch in source.iter_batches():
+                writer.write_batch(batch)
+    return csv_path
+
+
+def load_cached_range(
+    symbol: str, interval: str
+) -> Optional[tuple[pd.Timestamp, pd.Timestamp]]:
+    """Return the first and last cached open_time for a symbol, or None if nothing is cached."""
+    file_path = _crypto_data_path(symbol, interval)
+    if not file_path.exists():
+        return None
+    open_times = pd.read_parquet(file_path, columns=["open_time"])["open_time"]
+    if open_times.empty:
+        return None
+    return open_times.min(), open_times.max()
+
+
+def save_crypto_data(
+    df: pd.DataFrame, symbol: str, interval: str, write_csv: bool = False
+) -> Path:
+    file_path = _crypto_data_path(symbol, interval)
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False), file_path, compression="zstd"
+    )
+    if write_csv:
+        _export_csv(file_path)
     return file_path
 
+
+def stream_binance_klines(
+    symbol: str,
+    interval: str = DEFAULT_INTERVAL,
+    start_date: str | datetime = DEFAULT_START_DATE,
+    end_date: Optional[str | datetime] = None,
+    append: bool = False,
+    write_csv: bool = False,
+    session: requests.Session = _SESSION,
+) -> tuple[Path, int]:
+    """
+    Fetch klines page by page straight into the symbol's Parquet file.
+
+    Only one page is held in memory at a time. With append=True, cached bars
+    older than start_date are kept and everything after is replaced by the
+    fetched bars. Returns the file path and the number of rows fetched.
+    """
+    file_path = _crypto_data_path(symbol, interval)
+    tmp_path = file_path.with_name(f"{file_path.name}.tmp")
+    start_ms = _to_millis(start_date)
+    num_rows = 0
+
+    try:
+        with pq.ParquetWriter(tmp_path, KLINE_SCHEMA, compression="zstd") as writer:
+            if append and file_path.exists():
+                # KLINE_SCHEMA timestamps are in ns
+                cutoff = pa.scalar(
+                    start_ms * 1_000_000, type=KLINE_SCHEMA.field("open_time").type
+                )
+                with pq.ParquetFile(file_path) as cached:
+                    for batch in cached.iter_batches(columns=KLINE_COLUMNS):
+                        batch = batch.filter(pc.less(batch["open_time"], cutoff))
+                        if batch.num_rows:
+                            writer.write_batch(batch.cast(KLINE_SCHEMA))
+
+            for page in _iter_kline_pages(
+                symbol, interval, start_ms, _to_millis(end_date), session
+            ):
+                writer.write_batch(
+                    pa.RecordBatch.from_pandas(
+                        _klines_to_frame(page), schema=KLINE_SCHEMA, preserve_index=False
+                    )
+                )
+                num_rows += len(page)
+
+        if not num_rows:
+            raise ValueError(f"No data returned for {symbol}")
+        tmp_path.replace(file_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    if write_csv:
+        _export_csv(file_path)
+    return file_path, num_rows
+
 # =========================
 # Orchestration
 # =========================
 
+def _resume_point(
+    symbol: str,
+    interval: str,
+    start_date: str | datetime,
+    end_date: Optional[str | datetime],
+) -> Optional[pd.Timestamp]:
+    """Return the cached open_time to resume from, or None when a full fetch is needed."""
+    cached = load_cached_range(symbol, interval)
+    if cached is None:
+        return None
+    first_open_time, last_open_time = cached
+    start_ms = _to_millis(start_date)
+    end_ms = _to_millis(end_date)
+    last_ms = _to_millis(last_open_time)
+
+    # The requested range must run past the end of the cache
+    if start_ms > last_ms or (end_ms is not None and end_ms <= last_ms):
+        return None
+
+    first_ms = _to_millis(first_open_time)
+    if start_ms < first_ms:
+        # Backfill instead if Binance has bars older than the cache in this range
+        earliest_ms = _fetch_first_open_time(symbol, interval, start_ms)
+        if earliest_ms is not None and earliest_ms < first_ms:
+            return None
+
+    return last_open_time
+
+
+def _ingest_symbol(
+    symbol: str,
+    interval: str,
+    start_date: str | datetime,
+    end_date: Optional[str | datetime],
+    incremental: bool,
+    write_csv: bool,
+) -> None:
+    last_open_time = (
+        _resume_point(symbol, interval, start_date, end_date) if incremental else None
+    )
+    if last_open_time is not None:
+        # Re-fetch the last cached bar too, it may have been saved while still open
+        start_date = last_open_time
+        logger.info(f"Resuming {symbol} ({interval}) from {last_open_time}")
+    else:
+        logger.info(f"Ingesting {symbol} ({interval})")
+    path, num_rows = stream_binance_klines(
+        symbol=symbol,
+        interval=interval,
+        start_date=start_date,
+        end_date=end_date,
+        append=last_open_time is not None,
+        write_csv=write_csv,
+    )
+    logger.info(f"{num_rows} rows saved to {path}")
+
+
 def run_crypto_ingestion(
     symbols: Iterable[str] = DEFAULT_SYMBOLS,
     interval: str = DEFAULT_INTERVAL,
     start_date: str | datetime = DEFAULT_START_DATE,
     end_date: Optional[str | datetime] = None,
+    max_workers: int = MAX_WORKERS,
+    incremental: bool = True,
+    write_csv: bool = False,
 ) -> None:
-    for symbol in symbols:
-        logger.info(f"Ingesting {symbol} ({interval})")
-        df = fetch_binance_klines(
-            symbol=symbol,
-            interval=interval,
-            start_date=start_date,
-            end_date=end_date,
-        )
-        path = save_crypto_data(df, symbol, interval)
-        logger.info(f"{len(df)} rows saved to {path}")
+    # Symbols are independent and network-bound, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(
+                _ingest_symbol,
+                symbol,
+                interval,
+                start_date,
+                end_date,
+                incremental,
+                write_csv,
+            )
+            for symbol in symbols
+        ]
+        for future in futures:
+            future.result()
 
 # =========================
 # Entry Point
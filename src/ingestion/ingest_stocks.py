@@ -1,10 +1,19 @@
 import os
 import time
-import requests
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 
+from src.utils.http import build_session
+from src.utils.rate_limit import TokenBucket
+
 load_dotenv()
 
 API_KEY = os.getenv("ALPHAVANTAGE_API_KEY")  # put this in a .env file
@@ -30,19 +39,67 @@ BRENT_API_KEY = os.getenv("ALPHAVANTAGE_BRENT_API_KEY", COMMODITY_API_KEY)
 NAT_GAS_API_KEY = os.getenv("ALPHAVANTAGE_NATURAL_GAS_API_KEY", COMMODITY_API_KEY)
 MAX_RETRIES = int(os.getenv("ALPHAVANTAGE_MAX_RETRIES", "2"))
 RETRY_DELAY_SECONDS = int(os.getenv("ALPHAVANTAGE_RETRY_DELAY_SECONDS", "60"))
+MAX_WORKERS = int(os.getenv("ALPHAVANTAGE_MAX_WORKERS", "5"))
+# Also write a CSV copy next to each Parquet file for external consumers
+WRITE_CSV = os.getenv("ALPHAVANTAGE_WRITE_CSV", "false").lower() in ("1", "true", "yes")
+
+_SESSION = build_session("stock-ingestion/1.0")
+
+# Free tier allows 5 calls/min; stocks and commodities share one pool.
+# capacity + 60 * refill_rate = 5, i.e. one call every 15s at most
+AV_BUCKET = TokenBucket(capacity=1, refill_rate=4 / 60)
 
 DATA_DIR = Path("data/raw/stocks")
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 STOCK_SYMBOLS = ["AAPL", "MSFT", "TSLA", "IBM"]
 
+# Dictionary-encoded symbol, Arrow-backed dates and numerics
+SYMBOL_TYPE = pa.dictionary(pa.int32(), pa.string())
+STOCK_SCHEMA = pa.schema(
+    [
+        ("symbol", SYMBOL_TYPE),
+        ("date", pa.date32()),
+        ("open", pa.float64()),
+        ("high", pa.float64()),
+        ("low", pa.float64()),
+        ("close", pa.float64()),
+        ("adjusted_close", pa.float64()),
+        ("volume", pa.int64()),
+    ]
+)
+COMMODITY_SCHEMA = pa.schema(
+    [
+        ("symbol", SYMBOL_TYPE),
+        ("date", pa.date32()),
+        ("price", pa.float64()),
+    ]
+)
+
+
+def _symbol_array(symbol: str, length: int) -> pa.DictionaryArray:
+    return pa.DictionaryArray.from_arrays(
+        pa.array(np.zeros(length, dtype=np.int32)), pa.array([symbol])
+    )
+
+
+def _to_date32(dates: pa.Array | pa.ChunkedArray) -> pa.Array | pa.ChunkedArray:
+    # Alpha Vantage dates are always YYYY-MM-DD
+    return pc.strptime(dates, format="%Y-%m-%d", unit="s").cast(pa.date32())
+
+
+def _is_rate_limit_message(info_msg: str) -> bool:
+    lowered = info_msg.lower()
+    return "rate limit" in lowered or "call frequency" in lowered
+
 
 def fetch_daily_stock(
     symbol: str, function: str, output_size: str, api_key: str = API_KEY
 ) -> pd.DataFrame:
     """Fetch daily OHLCV data for one stock."""
     current_output_size = output_size
-    for attempt in range(1, 3):  # at most one fallback attempt (full -> compact)
+    attempt = 1
+    while True:
         params = {
             "function": function,
             "symbol": symbol,
@@ -50,58 +107,112 @@ def fetch_daily_stock(
             "datatype": "json",
             "apikey": api_key,
         }
-        resp = requests.get(BASE_URL, params=params, timeout=30)
+        AV_BUCKET.acquire()
+        resp = _SESSION.get(BASE_URL, params=params, timeout=30)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
 
         info_msg = data.get("Information") or data.get("Note")
-        if info_msg:
-            premium_full = "outputsize=full" in info_msg.lower() or "premium feature" in info_msg.lower()
-            if premium_full and current_output_size.lower() == "full":
-                print(
-                    f"Alpha Vantage message for {symbol}: {info_msg} "
-                    "Retrying with outputsize=compact..."
-                )
-                current_output_size = "compact"
-                continue
-
-            raise ValueError(
-                f"Alpha Vantage returned a message for {symbol}: {info_msg} "
-                f"(function={function}, outputsize={current_output_size}). "
-                "Set ALPHAVANTAGE_STOCK_OUTPUTSIZE=compact in your .env to avoid premium limits."
+        if not info_msg:
+            break
+
+        premium_full = "outputsize=full" in info_msg.lower() or "premium feature" in info_msg.lower()
+        if premium_full and current_output_size.lower() == "full":
+            # at most one fallback attempt (full -> compact)
+            print(
+                f"Alpha Vantage message for {symbol}: {info_msg} "
+                "Retrying with outputsize=compact..."
+            )
+            current_output_size = "compact"
+            continue
+
+        if _is_rate_limit_message(info_msg) and attempt < MAX_RETRIES:
+            print(
+                f"Alpha Vantage message for {symbol}: {info_msg}. "
+                f"Waiting {RETRY_DELAY_SECONDS}s then retrying "
+                f"({attempt}/{MAX_RETRIES})..."
             )
-        break
+            time.sleep(RETRY_DELAY_SECONDS)
+            attempt += 1
+            continue
+
+        raise ValueError(
+            f"Alpha Vantage returned a message for {symbol}: {info_msg} "
+            f"(function={function}, outputsize={current_output_size}). "
+            "Set ALPHAVANTAGE_STOCK_OUTPUTSIZE=compact in your .env to avoid premium limits."
+        )
 
     # Alpha Vantage returns nested JSON; "Time Series (Daily)" contains date→values
     key = "Time Series (Daily)"
     if key not in data:
         raise ValueError(f"Unexpected response for {symbol}: {data}")
 
-    records = []
-    for date, values in data[key].items():
-        close = float(values["4. close"])
-        adjusted_close = float(values.get("5. adjusted close", close))
+    # Fill one array per column instead of building a dict per row
+    series = data[key]
+    n = len(series)
+    dates = [None] * n
+    opens = np.empty(n, dtype=np.float64)
+    highs = np.empty(n, dtype=np.float64)
+    lows = np.empty(n, dtype=np.float64)
+    closes = np.empty(n, dtype=np.float64)
+    adjusted_closes = np.empty(n, dtype=np.float64)
+    volumes = np.empty(n, dtype=np.int64)
+    for i, (date, values) in enumerate(series.items()):
         volume = values.get("6. volume") or values.get("5. volume")
         if volume is None:
             raise ValueError(f"Volume not found in response for {symbol}: {values}")
 
-        records.append(
-            {
-                "symbol": symbol,
-                "date": date,
-                "open": float(values["1. open"]),
-                "high": float(values["2. high"]),
-                "low": float(values["3. low"]),
-                "close": close,
-                "adjusted_close": adjusted_close,
-                "volume": int(volume),
-            }
+        dates[i] = date
+        opens[i] = float(values["1. open"])
+        highs[i] = float(values["2. high"])
+        lows[i] = float(values["3. low"])
+        closes[i] = float(values["4. close"])
+        adjusted_closes[i] = float(values.get("5. adjusted close", closes[i]))
+        volumes[i] = int(volume)
+
+    table = pa.table(
+        {
+            "symbol": _symbol_array(symbol, n),
+            "date": _to_date32(pa.array(dates, type=pa.string())),
+            "open": opens,
+            "high": highs,
+            "low": lows,
+            "close": closes,
+            "adjusted_close": adjusted_closes,
+            "volume": volumes,
+        },
+        schema=STOCK_SCHEMA,
+    )
+    return table.sort_by("date").to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _check_av_message(
+    info_msg: str, function_name: str, interval: str, key_to_use: str, attempt: int
+) -> str:
+    """Handle an Alpha Vantage limit message: return the key to retry with, or raise."""
+    # Try demo fallback once if the primary key hit rate limits; this does
+    # not depend on the remaining retry budget
+    if COMMODITY_FALLBACK_KEY and key_to_use != COMMODITY_FALLBACK_KEY:
+        print(
+            f"Alpha Vantage message for {function_name}: {info_msg}. "
+            "Retrying with fallback key..."
+        )
+        return COMMODITY_FALLBACK_KEY
+
+    if attempt >= MAX_RETRIES:
+        raise ValueError(
+            f"Alpha Vantage returned a message for {function_name}: {info_msg} "
+            f"(interval={interval}). Try waiting a minute or set "
+            "ALPHAVANTAGE_COMMODITY_FALLBACK_KEY=demo in your .env."
         )
 
-    df = pd.DataFrame(records)
-    df["date"] = pd.to_datetime(df["date"])
-    df.sort_values("date", inplace=True)
-    return df
+    print(
+        f"Alpha Vantage message for {function_name}: {info_msg}. "
+        f"Waiting {RETRY_DELAY_SECONDS}s then retrying "
+        f"({attempt}/{MAX_RETRIES})..."
+    )
+    time.sleep(RETRY_DELAY_SECONDS)
+    return key_to_use
 
 
 def fetch_commodity(
@@ -109,67 +220,45 @@ def fetch_commodity(
 ) -> pd.DataFrame:
     """Fetch commodity prices from Alpha Vantage (e.g., NATURAL_GAS, BRENT)."""
     key_to_use = api_key
-    fallback_used = False
+    attempt = 1
 
-    for attempt in range(1, MAX_RETRIES + 1):
+    while True:
         params = {
             "function": function_name,
             "interval": interval,
             "datatype": "json",
             "apikey": key_to_use,
         }
-        resp = requests.get(BASE_URL, params=params, timeout=30)
+        AV_BUCKET.acquire()
+        resp = _SESSION.get(BASE_URL, params=params, timeout=30)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
 
         info_msg = data.get("Information") or data.get("Note")
-        if info_msg:
-            # Try demo fallback once if the primary key hit rate limits
-            if (
-                not fallback_used
-                and COMMODITY_FALLBACK_KEY
-                and key_to_use != COMMODITY_FALLBACK_KEY
-            ):
-                print(
-                    f"Alpha Vantage message for {function_name}: {info_msg}. "
-                    "Retrying with fallback key..."
-                )
-                key_to_use = COMMODITY_FALLBACK_KEY
-                fallback_used = True
-                continue
-
-            if attempt < MAX_RETRIES:
-                print(
-                    f"Alpha Vantage message for {function_name}: {info_msg}. "
-                    f"Waiting {RETRY_DELAY_SECONDS}s then retrying "
-                    f"({attempt}/{MAX_RETRIES})..."
-                )
-                time.sleep(RETRY_DELAY_SECONDS)
-                continue
-
-            raise ValueError(
-                f"Alpha Vantage returned a message for {function_name}: {info_msg} "
-                f"(interval={interval}). Try waiting a minute or set "
-                "ALPHAVANTAGE_COMMODITY_FALLBACK_KEY=demo in your .env."
-            )
-
-        if "data" not in data:
-            raise ValueError(f"Unexpected response for {function_name}: {data}")
+        if not info_msg:
+            break
+        key_to_use = _check_av_message(
+            info_msg, function_name, interval, key_to_use, attempt
+        )
+        attempt += 1
 
-        records = data["data"]
-        if not records:
-            raise ValueError(f"{function_name} returned no data.")
+    if "data" not in data:
+        raise ValueError(f"Unexpected response for {function_name}: {data}")
 
-        df = pd.DataFrame(records)
-        df.rename(columns={"value": "price"}, inplace=True)
-        df["symbol"] = symbol_label
-        df["date"] = pd.to_datetime(df["date"])
-        df["price"] = df["price"].astype(float)
-        df = df[["symbol", "date", "price"]]
-        df.sort_values("date", inplace=True)
-        return df
+    records = data["data"]
+    if not records:
+        raise ValueError(f"{function_name} returned no data.")
 
-    raise RuntimeError(f"Failed to fetch {function_name} after {MAX_RETRIES} attempts.")
+    raw = pa.Table.from_pylist(records)
+    table = pa.table(
+        {
+            "symbol": _symbol_array(symbol_label, raw.num_rows),
+            "date": _to_date32(raw["date"]),
+            "price": raw["value"].cast(pa.float64()),
+        },
+        schema=COMMODITY_SCHEMA,
+    )
+    return table.sort_by("date").to_pandas(types_mapper=pd.ArrowDtype)
 
 
 def fetch_natural_gas(interval: str) -> pd.DataFrame:
@@ -180,42 +269,49 @@ def fetch_brent(interval: str) -> pd.DataFrame:
     return fetch_commodity("BRENT", interval, "BRENT", BRENT_API_KEY)
 
 
+def save_stock_data(df: pd.DataFrame, name: str) -> Path:
+    """Write a frame to DATA_DIR as ZSTD-compressed Parquet (plus CSV if WRITE_CSV)."""
+    out_path = DATA_DIR / f"{name}.parquet"
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, out_path, compression="zstd")
+    if WRITE_CSV:
+        pacsv.write_csv(table, out_path.with_suffix(".csv"))
+    return out_path
+
+
+def ingest_stock(symbol: str) -> Path:
+    print(f"Fetching {symbol}...")
+    df = fetch_daily_stock(symbol, STOCK_FUNCTION, STOCK_OUTPUT_SIZE)
+    out_path = save_stock_data(df, f"{symbol}_daily")
+    print(f"Saved {len(df)} rows to {out_path}")
+    return out_path
+
+
 def main():
     if API_FUNCTION.upper() == "NATURAL_GAS":
         print(f"Fetching NATURAL_GAS (interval={API_INTERVAL})...")
         df = fetch_natural_gas(API_INTERVAL)
-        out_path = DATA_DIR / f"natural_gas_{API_INTERVAL}.csv"
-        df.to_csv(out_path, index=False)
+        out_path = save_stock_data(df, f"natural_gas_{API_INTERVAL}")
         print(f"Saved {len(df)} rows to {out_path}")
-        # Pause briefly to respect rate limits before the next commodity call
-        time.sleep(15)
         print(f"Fetching BRENT (interval={API_INTERVAL})...")
         brent_df = fetch_brent(API_INTERVAL)
-        brent_path = DATA_DIR / f"brent_{API_INTERVAL}.csv"
-        brent_df.to_csv(brent_path, index=False)
+        brent_path = save_stock_data(brent_df, f"brent_{API_INTERVAL}")
         print(f"Saved {len(brent_df)} rows to {brent_path}")
-        # Pause before stock call to respect rate limits
-        time.sleep(15)
         print(f"Fetching IBM stock (function={STOCK_FUNCTION}, outputsize={STOCK_OUTPUT_SIZE})...")
         ibm_df = fetch_daily_stock("IBM", STOCK_FUNCTION, STOCK_OUTPUT_SIZE)
-        ibm_path = DATA_DIR / "IBM_daily.csv"
-        ibm_df.to_csv(ibm_path, index=False)
+        ibm_path = save_stock_data(ibm_df, "IBM_daily")
         print(f"Saved {len(ibm_df)} rows to {ibm_path}")
     elif API_FUNCTION.upper() == "BRENT":
         print(f"Fetching BRENT (interval={API_INTERVAL})...")
         brent_df = fetch_brent(API_INTERVAL)
-        brent_path = DATA_DIR / f"brent_{API_INTERVAL}.csv"
-        brent_df.to_csv(brent_path, index=False)
+        brent_path = save_stock_data(brent_df, f"brent_{API_INTERVAL}")
         print(f"Saved {len(brent_df)} rows to {brent_path}")
     else:
-        for symbol in STOCK_SYMBOLS:
-            print(f"Fetching {symbol}...")
-            df = fetch_daily_stock(symbol, STOCK_FUNCTION, STOCK_OUTPUT_SIZE)
-            out_path = DATA_DIR / f"{symbol}_daily.csv"
-            df.to_csv(out_path, index=False)
-            print(f"Saved {len(df)} rows to {out_path}")
-            # Respect free tier limits (5 calls/min); sleep a bit between requests
-            time.sleep(15)
+        # Overlap the network calls; AV_BUCKET keeps them within the quota
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            futures = [pool.submit(ingest_stock, symbol) for symbol in STOCK_SYMBOLS]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,26 @@
+"""
+Shared HTTP session setup for the ingestion modules.
+
+Sessions built here retry transient failures and keep a connection pool
+large enough for the concurrent ingestion workers.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_RETRY = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+)
+
+
+def build_session(user_agent: str) -> requests.Session:
+    """Return a requests session with retries and keep-alive pooling on https."""
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=_RETRY, pool_connections=16, pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": user_agent})
+    return session
@@ -0,0 +1,47 @@
+"""
+Client-side rate limiting helpers.
+
+A token bucket shared by every caller of an API keeps the average request
+rate within the provider quota while still allowing short bursts.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Holds at most `capacity` tokens and refills at `refill_rate` tokens per
+    second. `acquire` blocks until enough tokens are available. The bucket
+    starts full, so any window of T seconds admits up to
+    `capacity + refill_rate * T` tokens; size both so that stays within quota.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float) -> None:
+        if capacity <= 0 or refill_rate <= 0:
+            raise ValueError("capacity and refill_rate must be positive")
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost: float = 1) -> None:
+        if cost > self.capacity:
+            raise ValueError(f"cost {cost} exceeds bucket capacity {self.capacity}")
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._tokens + (now - self._last) * self.refill_rate,
+                    self.capacity,
+                )
+                self._last = now
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    return
+                wait = (cost - self._tokens) / self.refill_rate
+            # Sleep outside the lock so other callers can refill-check meanwhile
+            time.sleep(wait)